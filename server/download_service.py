@@ -1,13 +1,33 @@
 import os
 import uuid
 import subprocess
+import threading
 import time
 from pathlib import Path
 from typing import Optional, Tuple
 from models import DownloadRequest
 from ffmpeg_util import supported_video_exts, supported_audio_exts
+from postprocess import FFmpegJob, env_int, postprocess_pool
 from ytdlp_config import cli_base_args
 
+# Printed by yt-dlp once per downloaded stream: vcodec, acodec, final path
+_STREAM_PRINT = "after_move:%(vcodec)s\t%(acodec)s\t%(filepath)s"
+
+# ffmpeg encoder per audio container
+_AUDIO_CODECS = {"mp3": "libmp3lame", "m4a": "aac", "opus": "libopus", "wav": "pcm_s16le"}
+
+# Source extensions that can be stream-copied into mp4 (mirrors yt-dlp's merge check)
+_MP4_COMPATIBLE = {"mp4", "m4a", "m4v", "mov", "mp3"}
+_WEBM_COMPATIBLE = {"webm", "weba"}
+
+# yt-dlp format sort (-S) that prefers streams fitting a requested container
+_CONTAINER_SORT = {"mp4": "ext:mp4:m4a", "webm": "ext:webm:webm"}
+
+# (path, vcodec, acodec) of a stream fetched by yt-dlp
+Stream = Tuple[Path, str, str]
+# (primary source, final output, ffmpeg job or None when a rename suffices)
+PostProcessPlan = Tuple[Path, Path, Optional[FFmpegJob]]
+
 class DownloadService:
     
     def __init__(self, downloads_dir: str = "downloads"):
@@ -25,14 +45,17 @@ class DownloadService:
         self.downloads_dir = dl_path
         self.downloads_dir.mkdir(parents=True, exist_ok=True)
         self._cleanup_interval = 3600
+        # yt-dlp runs are network-bound; ffmpeg work goes to postprocess_pool
+        self._network_slots = threading.BoundedSemaphore(env_int("FETCHLY_NETWORK_WORKERS", 8))
 
     def _build_ytdlp_command(self, request: DownloadRequest, marker: str | None = None) -> tuple[list, str]:
         if not marker:
             marker = f"{int(time.time())}_{str(uuid.uuid4())[:8]}"
-        unique_filename = f"%(title)s_{marker}.%(ext)s"
+        # Streams are fetched separately and merged/extracted in the post-processing stage
+        unique_filename = f"%(title)s_{marker}.f%(format_id)s.%(ext)s"
         output_template = str(self.downloads_dir / unique_filename)
 
-        command: list[str] = ["yt-dlp", "-o", output_template]
+        command: list[str] = ["yt-dlp", "-o", output_template, "--no-simulate", "-O", _STREAM_PRINT]
         # Add shared CLI base args (cookies, UA, TLS)
         command.extend(cli_base_args())
         # Finally add the URL
@@ -40,15 +63,22 @@ class DownloadService:
 
         section = self._build_download_sections(request.start_time, request.end_time)
         if section:
+            # Cutting stays in the network stage: yt-dlp's ffmpeg downloader fetches
+            # only the range with a stream copy, so it is I/O-bound. Moving it to the
+            # pool would mean downloading the whole source first. One ffmpeg runs per
+            # stream, so cap each at a single thread.
             command.extend(["--download-sections", section])
+            command.extend(["--downloader-args", "ffmpeg_o:-threads 1"])
 
         if request.media_type == "video":
             format_selector = self._build_video_format_selector(request)
             command.extend(["-f", format_selector])
-            merge_pref = request.extension if request.extension else "mp4/mkv/webm"
-            command.extend(["--merge-output-format", merge_pref])
+            # Favour streams that can be stream-copied into the requested container
+            sort = _CONTAINER_SORT.get(request.extension or "")
+            if sort:
+                command.extend(["-S", sort])
         elif request.media_type == "audio":
-            command.extend(self._build_audio_command(request))
+            command.extend(["-f", "ba/b"])
 
         return command, marker
 
@@ -69,11 +99,10 @@ class DownloadService:
             height_cap = "1080"
 
         filt = f"[height<={height_cap}]" if height_cap else ""
-        return f"bv*{filt}+ba/b{filt}"
+        # ',' instead of '+' downloads both streams without yt-dlp merging them
+        return f"(bv*{filt},ba)/b{filt}"
 
-    def _build_audio_command(self, request: DownloadRequest) -> list:
-        audio_cmd = ["-x"]  # Extract audio
-        
+    def _choose_audio_ext(self, request: DownloadRequest) -> Optional[str]:
         chosen_ext = request.extension
         if not chosen_ext:
             # preference order
@@ -83,42 +112,137 @@ class DownloadService:
                 if p in avail:
                     chosen_ext = p
                     break
-            # if still None, let yt-dlp decide
-        if chosen_ext:
-            audio_cmd.extend(["--audio-format", chosen_ext])
-            
-        # For audio quality, yt-dlp expects bitrate values like 128, 192, etc.
-        if request.quality:
-            # Remove 'k' suffix if present and validate
-            quality_value = request.quality.replace('k', '').replace('K', '')
-            try:
-                bitrate = int(quality_value)
-                audio_cmd.extend(["--audio-quality", str(bitrate)])
-            except ValueError:
-                pass
-                
-        return audio_cmd
+            # if still None, keep the source container
+        return chosen_ext
 
-    def _find_downloaded_file(self, marker: str | None = None) -> Optional[Path]:
-        """Find the downloaded file; if marker provided, prefer files containing it"""
+    def _audio_bitrate(self, request: DownloadRequest) -> Optional[int]:
+        if not request.quality:
+            return None
+        # Remove 'k' suffix if present and validate
+        quality_value = request.quality.replace('k', '').replace('K', '')
         try:
-            files = [
-                f for f in self.downloads_dir.iterdir() 
-                if f.is_file() and not f.name.endswith(('.part', '.tmp'))
-            ]
-
-            if not files:
-                return None
+            return int(quality_value)
+        except ValueError:
+            return None
 
-            if marker:
-                marked = [f for f in files if marker in f.name]
-                if marked:
-                    return max(marked, key=lambda f: f.stat().st_mtime)
+    def _parse_streams(self, stdout: str) -> list[Stream]:
+        """Parse the per-stream lines printed by yt-dlp via _STREAM_PRINT"""
+        streams: list[Stream] = []
+        for line in stdout.splitlines():
+            parts = line.split("\t", 2)
+            if len(parts) != 3:
+                continue
+            path = Path(parts[2].strip())
+            if path.is_file():
+                streams.append((path, parts[0], parts[1]))
+        return streams
+
+    @staticmethod
+    def _is_audio_only(stream: Stream) -> bool:
+        # yt-dlp's rule: only an explicit "none" means no video; unknown (NA) counts as present
+        return stream[1] == "none"
+
+    def _output_path(self, source: Path, marker: str, ext: str) -> Path:
+        """Final name: strip the per-stream `.f<format_id>` suffix from the source"""
+        base = source.name.split(f"_{marker}")[0]
+        return self.downloads_dir / f"{base}_{marker}.{ext}"
+
+    @staticmethod
+    def _can_copy_into(ext: str, sources: list[Path]) -> bool:
+        """Whether `-c copy` of all sources into an `ext` container is expected to work"""
+        exts = {p.suffix.lstrip(".").lower() for p in sources}
+        if ext == "mkv":
+            return True
+        if ext == "mp4":
+            return exts <= _MP4_COMPATIBLE
+        if ext == "webm":
+            return exts <= _WEBM_COMPATIBLE
+        return exts == {ext}
+
+    def _pick_merge_ext(self, sources: list[Path]) -> str:
+        allowed = supported_video_exts()
+        if "mp4" in allowed and self._can_copy_into("mp4", sources):
+            return "mp4"
+        if "mkv" in allowed:
+            return "mkv"
+        return next(iter(sorted(allowed)), "mkv")
+
+    def _build_video_job(self, request: DownloadRequest, streams: list[Stream], marker: str) -> PostProcessPlan:
+        """Merge separate video/audio streams, or remux a single one if needed"""
+        videos = [s for s in streams if not self._is_audio_only(s)]
+        audios = [s for s in streams if self._is_audio_only(s)]
+        if not videos:
+            raise ValueError("No video stream was downloaded")
+
+        video_path = videos[0][0]
+        sources = [video_path] + ([audios[0][0]] if audios else [])
+
+        if len(sources) == 1:
+            ext = request.extension
+            source_ext = video_path.suffix.lstrip(".").lower()
+            if not ext or ext == source_ext or not self._can_copy_into(ext, sources):
+                # Like yt-dlp, leave a single file in its own container rather than fail
+                return video_path, self._output_path(video_path, marker, source_ext), None
+            output = self._output_path(video_path, marker, ext)
+            args = ["-map", "0:v:0", "-map", "0:a:0?", "-c", "copy"]
+            return video_path, output, FFmpegJob("remux", [str(video_path)], str(output), args)
+
+        # An explicit container is honoured or the merge fails, as with --merge-output-format
+        ext = request.extension or self._pick_merge_ext(sources)
+        output = self._output_path(video_path, marker, ext)
+        args = ["-map", "0:v:0", "-map", "1:a:0", "-c", "copy"]
+        return video_path, output, FFmpegJob("merge", [str(p) for p in sources], str(output), args)
+
+    def _build_audio_job(self, request: DownloadRequest, streams: list[Stream], marker: str) -> PostProcessPlan:
+        """Extract audio into the requested container, copying when codecs already match"""
+        audio_only = [s for s in streams if self._is_audio_only(s)]
+        source, _, acodec = (audio_only or streams)[0]
+
+        ext = self._choose_audio_ext(request)
+        if not ext:
+            return source, self._output_path(source, marker, source.suffix.lstrip(".")), None
+        output = self._output_path(source, marker, ext)
+
+        bitrate = self._audio_bitrate(request)
+        codec_matches = acodec.startswith(("mp4a", "aac")) if ext == "m4a" else acodec == ext
+        if bitrate is None and codec_matches:
+            return source, output, FFmpegJob("remux", [str(source)], str(output), ["-vn", "-c:a", "copy"])
+
+        args = ["-vn", "-c:a", _AUDIO_CODECS.get(ext, "copy")]
+        if bitrate and ext != "wav":
+            args.extend(["-b:a", f"{bitrate}k"])
+        return source, output, FFmpegJob("extract", [str(source)], str(output), args)
+
+    def _postprocess(self, request: DownloadRequest, streams: list[Stream], marker: str) -> Path:
+        """Run the CPU-bound stage on the shared pool and drop intermediate files"""
+        try:
+            if request.media_type == "video":
+                source, output, job = self._build_video_job(request, streams, marker)
+            else:
+                source, output, job = self._build_audio_job(request, streams, marker)
 
-            return max(files, key=lambda f: f.stat().st_mtime)
+            if job is None:
+                # Already in the right container; just give it its final name
+                source.replace(output)
+                return output
 
-        except Exception:
-            return None
+            try:
+                result = postprocess_pool.run(job)
+            except subprocess.TimeoutExpired:
+                output.unlink(missing_ok=True)
+                raise ValueError("Post-processing timed out after 5 minutes")
+            except TimeoutError:
+                output.unlink(missing_ok=True)
+                raise ValueError("Server is busy processing other downloads, please try again")
+
+            if result.returncode != 0 or not output.is_file():
+                output.unlink(missing_ok=True)
+                lines = result.stderr.strip().splitlines()
+                raise ValueError(f"Post-processing failed: {lines[-1] if lines else 'ffmpeg error'}")
+            return output
+        finally:
+            for path, _, _ in streams:
+                path.unlink(missing_ok=True)
 
     def download_media(self, request: DownloadRequest) -> Tuple[str, str]:
 
@@ -142,13 +266,15 @@ class DownloadService:
             # Build and execute command
             command, marker = self._build_ytdlp_command(request)
 
-            result = subprocess.run(
-                command,
-                capture_output=True,
-                text=True,
-                timeout=300,  # 5 minute timeout
-                cwd=str(self.downloads_dir.parent)  # Set working directory
-            )
+            # Network stage: fetch raw streams, bounded separately from ffmpeg work
+            with self._network_slots:
+                result = subprocess.run(
+                    command,
+                    capture_output=True,
+                    text=True,
+                    timeout=300,  # 5 minute timeout
+                    cwd=str(self.downloads_dir.parent)  # Set working directory
+                )
 
             if result.returncode != 0:
                 error_msg = result.stderr.strip()
@@ -161,12 +287,12 @@ class DownloadService:
                 else:
                     raise ValueError(f"Download failed: {error_msg}")
 
-            # Find the downloaded file
-            downloaded_file = self._find_downloaded_file(marker)
-
-            if not downloaded_file:
+            # Post-processing stage: merge/remux/extract on the CPU pool
+            streams = self._parse_streams(result.stdout)
+            if not streams:
                 raise ValueError("No file was downloaded")
 
+            downloaded_file = self._postprocess(request, streams, marker)
             return str(downloaded_file), downloaded_file.name
 
         except subprocess.TimeoutExpired:
@@ -1,6 +1,7 @@
 from fastapi import FastAPI, HTTPException, Query, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
 from models import DownloadRequest, DownloadResponse, ErrorResponse, MediaInfo
 from services import MediaFormatService
 from download_service import download_service
@@ -65,7 +66,8 @@ async def get_media_info(url: str = Query(..., description="Media URL")):
 )
 async def download_media(request: DownloadRequest, background_tasks: BackgroundTasks, req: Request):
     try:
-        file_path, filename = download_service.download_media(request)
+        # Blocking download runs off the event loop so requests can overlap
+        file_path, filename = await run_in_threadpool(download_service.download_media, request)
         
         # Schedule file cleanup
         background_tasks.add_task(download_service.cleanup_file, file_path)
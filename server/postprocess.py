@@ -0,0 +1,170 @@
+"""
+CPU-bound post-processing stage for ffmpeg work.
+
+Provides:
+- FFmpegJob: one ffmpeg invocation tagged with a job class
+- PostProcessPool: bounded worker pool sized to the available cores
+- postprocess_pool: shared instance used by the download service
+- available_cores(), env_int(): sizing helpers
+
+Network downloads (yt-dlp) and ffmpeg jobs are queued separately so a burst of
+transcodes cannot starve fetching, and vice versa. Each job class carries a
+scheduling priority, an OS niceness and a thread allocation.
+"""
+from __future__ import annotations
+
+import itertools
+import os
+import queue
+import shutil
+import subprocess
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+
+def available_cores() -> int:
+    """Number of CPUs this process may run on (respects affinity/cgroups)."""
+    try:
+        return max(1, len(os.sched_getaffinity(0)))
+    except (AttributeError, OSError):
+        return max(1, os.cpu_count() or 1)
+
+
+def env_int(name: str, default: int) -> int:
+    """Positive integer from the environment, or `default` when unset/invalid."""
+    try:
+        value = int(os.environ.get(name, ""))
+    except ValueError:
+        return default
+    return value if value > 0 else default
+
+
+@dataclass(frozen=True)
+class JobClass:
+    """Scheduling profile for a kind of ffmpeg work.
+
+    Args:
+        priority: Queue order; lower runs first
+        niceness: Increment applied to the ffmpeg process (POSIX only)
+        encodes: True when the job re-encodes; stream copies get one thread
+    """
+    priority: int
+    niceness: int
+    encodes: bool
+
+
+# Remuxes are cheap and finish fast, so they jump ahead of audio encodes.
+JOB_CLASSES: Dict[str, JobClass] = {
+    "merge": JobClass(priority=0, niceness=5, encodes=False),
+    "remux": JobClass(priority=0, niceness=5, encodes=False),
+    "extract": JobClass(priority=1, niceness=10, encodes=True),
+}
+
+
+@dataclass
+class FFmpegJob:
+    """A single ffmpeg run.
+
+    The pool adds `-threads` to every input and to the output according to
+    the job class, so callers only describe streams and codecs.
+    """
+    job_class: str
+    inputs: list[str]
+    output: str
+    output_args: list[str] = field(default_factory=list)
+    timeout: int = 300
+    future: Future = field(default_factory=Future, repr=False)
+
+
+class PostProcessPool:
+    """Fixed set of worker threads draining a priority queue of ffmpeg jobs."""
+
+    def __init__(self, workers: Optional[int] = None, cores: Optional[int] = None):
+        self.cores = cores or available_cores()
+        # Half the cores by default leaves headroom for yt-dlp and the API
+        self.workers = workers or max(1, self.cores // 2)
+        self._queue: "queue.PriorityQueue[tuple[int, int, FFmpegJob]]" = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._threads: list[threading.Thread] = []
+
+    def threads_for(self, job_class: str) -> int:
+        """Thread allocation for one job so that all workers together fit the cores."""
+        if not JOB_CLASSES[job_class].encodes:
+            return 1
+        return max(1, self.cores // self.workers)
+
+    def submit(self, job: FFmpegJob) -> Future:
+        if job.job_class not in JOB_CLASSES:
+            raise ValueError(f"Unknown post-processing job class '{job.job_class}'")
+        self._ensure_started()
+        self._queue.put((JOB_CLASSES[job.job_class].priority, next(self._seq), job))
+        return job.future
+
+    def run(self, job: FFmpegJob, wait: Optional[float] = None) -> subprocess.CompletedProcess:
+        """Submit a job and block until it finishes.
+
+        Args:
+            job: The ffmpeg job to run
+            wait: Max seconds the job may sit in the queue (default: job timeout)
+
+        Raises:
+            TimeoutError: The job never left the queue and was cancelled
+        """
+        future = self.submit(job)
+        try:
+            return future.result(timeout=wait or job.timeout)
+        except TimeoutError:
+            if future.cancel():
+                raise
+            # Already running (or done): ffmpeg is bounded by its own timeout
+            return future.result()
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"postprocess-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def _worker(self) -> None:
+        while True:
+            _, _, job = self._queue.get()
+            try:
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    job.future.set_result(self._execute(job))
+                except BaseException as e:
+                    job.future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    def _execute(self, job: FFmpegJob) -> subprocess.CompletedProcess:
+        profile = JOB_CLASSES[job.job_class]
+        threads = str(self.threads_for(job.job_class))
+
+        command: list[str] = []
+        # Prefix with nice(1): preexec_fn is unsafe in a multi-threaded server
+        if os.name == "posix" and profile.niceness and shutil.which("nice"):
+            command.extend(["nice", "-n", str(profile.niceness)])
+        command.extend(["ffmpeg", "-hide_banner", "-nostdin", "-y"])
+        for src in job.inputs:
+            command.extend(["-threads", threads, "-i", src])
+        command.extend(job.output_args)
+        command.extend(["-threads", threads, job.output])
+
+        return subprocess.run(
+            command,
+            capture_output=True,
+            text=True,
+            timeout=job.timeout,
+        )
+
+
+# Global instance
+postprocess_pool = PostProcessPool(workers=env_int("FETCHLY_POSTPROCESS_WORKERS", 0) or None)